@@ -0,0 +1,49 @@
+"""Cached loader for the graphics prompt manifest.
+
+Both z_image_batch.py and organize_assets.py parse
+assets/graphics_batch.json on every invocation, and during art iteration
+that happens many times per session. load_manifest parses once and pickles
+the result under .cache/ next to an (mtime, sha1) stamp: unchanged files
+hit the cheap mtime check, a touched-but-identical file falls through to
+the hash check, and any real edit invalidates the cache.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+_CACHE_DIR = ".cache"
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return None
+
+
+def _write_cache(cache_path, entry):
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+    with open(cache_path, "wb") as f:
+        pickle.dump(entry, f)
+
+
+def load_manifest(json_path):
+    """Return the manifest's image_prompts list, parsing at most once per edit."""
+    stat = os.stat(json_path)
+    cache_path = os.path.join(_CACHE_DIR, os.path.basename(json_path) + ".pkl")
+    cached = _read_cache(cache_path)
+    if cached and cached["mtime"] == stat.st_mtime:
+        return cached["prompts"]
+    with open(json_path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    if cached and cached["sha1"] == digest:
+        cached["mtime"] = stat.st_mtime
+        _write_cache(cache_path, cached)
+        return cached["prompts"]
+    prompts = json.loads(raw)["image_prompts"]
+    _write_cache(cache_path, {"mtime": stat.st_mtime, "sha1": digest, "prompts": prompts})
+    return prompts
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Sort generated art into assets/textures.
+
+z_image_batch.py writes PNGs named `<id>_<timestamp>.png` into its output
+directory; this script matches them back to the ids in
+assets/graphics_batch.json and copies the newest candidate for each id to
+assets/textures/<id>.png. Run from the repo root.
+
+    python scripts/organize_assets.py
+    python scripts/organize_assets.py --SourceDir output --DryRun
+"""
+
+import argparse
+import bisect
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest_cache import load_manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Copy generated images into assets/textures.")
+    parser.add_argument("--Json", default=os.path.join("assets", "graphics_batch.json"),
+                        help="prompt manifest with the asset ids (default: assets/graphics_batch.json)")
+    parser.add_argument("--SourceDir", default="output",
+                        help="directory holding generated PNGs (default: output)")
+    parser.add_argument("--TargetDir", default=os.path.join("assets", "textures"),
+                        help="destination directory (default: assets/textures)")
+    parser.add_argument("--DryRun", action="store_true",
+                        help="report what would be copied without writing anything")
+    return parser.parse_args()
+
+
+def find_matches(sorted_files, img_id):
+    """Return every filename starting with `<img_id>_`.
+
+    The file list is sorted once, so each lookup is a bisect to the first
+    candidate plus a short forward walk, instead of scanning the whole
+    directory listing per id.
+    """
+    prefix = img_id + "_"
+    matches = []
+    for name in sorted_files[bisect.bisect_left(sorted_files, prefix):]:
+        if not name.startswith(prefix):
+            break
+        matches.append(name)
+    return matches
+
+
+def main():
+    args = parse_args()
+    ids = [entry["id"] for entry in load_manifest(args.Json)]
+
+    # scandir hands back mtimes without a second stat call per file.
+    mtimes = {e.name: e.stat().st_mtime for e in os.scandir(args.SourceDir) if e.is_file()}
+    sorted_files = sorted(mtimes)
+    os.makedirs(args.TargetDir, exist_ok=True)
+
+    pairs = []
+    missing = []
+    for img_id in ids:
+        matches = find_matches(sorted_files, img_id)
+        if not matches:
+            missing.append(img_id)
+            continue
+        newest = max(matches, key=mtimes.__getitem__)
+        pairs.append((os.path.join(args.SourceDir, newest),
+                      os.path.join(args.TargetDir, f"{img_id}.png")))
+
+    if args.DryRun:
+        for src, dst in pairs:
+            print(f"would copy {src} -> {dst}")
+    else:
+        # The copies are independent and I/O-bound; shutil releases the GIL
+        # in the underlying read/write syscalls, so a small thread pool
+        # keeps the disk queue full instead of draining one file at a time.
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda pair: shutil.copy2(*pair), pairs))
+        for src, dst in pairs:
+            print(f"copied {src} -> {dst}")
+
+    print(f"{len(pairs)}/{len(ids)} assets matched.")
+    if missing:
+        print("no generated image for: " + ", ".join(missing))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+"""Batch image generation for Second Story art assets.
+
+Renders every entry in assets/graphics_batch.json (or a single --Prompt)
+with Z-Image-Turbo via diffusers and writes PNGs to --OutputDir. Generated
+files are named `<id>_<timestamp>.png`; pick the keepers and copy them into
+assets/textures under their manifest id.
+
+Requires a CUDA GPU plus `torch` and `diffusers`; run it from the repo root
+so the default --Json path resolves.
+
+    python scripts/z_image_batch.py
+    python scripts/z_image_batch.py --Prompt "cozy lobby, pixel art" --Steps 9
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import sys
+import types
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Must be set before torch initializes CUDA: expandable segments let the
+# caching allocator grow one segment instead of fragmenting over a long
+# batch run, preserving large contiguous blocks for the next UNet step.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF",
+                      "expandable_segments:True,max_split_size_mb:512")
+
+import torch
+from diffusers import DiffusionPipeline
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+from manifest_cache import load_manifest
+
+MODEL_ID = "Tongyi-MAI/Z-Image-Turbo"
+
+# Strips anything unsafe for a filename out of a manifest id.
+_sanitize = re.compile(r"[^A-Za-z0-9_\-]").sub
+
+
+def setup_pipeline(compile_models=True, quant="none"):
+    """Load the Turbo pipeline onto the GPU in bf16, optionally quantizing
+    the UNet weights to int8 or fp8."""
+    pipe = DiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=torch.bfloat16)
+    pipe.to("cuda")
+    if quant != "none":
+        # Weight bandwidth, mostly through the attention/FFN linears, is the
+        # bottleneck for diffusion inference; weight-only quantization
+        # halves it and unlocks the INT8/FP8 Tensor-Core paths.
+        try:
+            from torchao.quantization import quantize_, int8_weight_only, float8_weight_only
+            quantize_(pipe.unet,
+                      float8_weight_only() if quant == "fp8" else int8_weight_only())
+            print(f"UNet linears quantized to {quant}.")
+        except ImportError as err:
+            print(f"torchao unavailable, staying bf16: {err}")
+    # Inference only: let cudnn autotune conv kernels and drop autograd
+    # bookkeeping for the whole run.
+    torch.backends.cudnn.benchmark = True
+    torch.set_grad_enabled(False)
+    # NHWC layout lets cudnn pick Tensor-Core-friendly conv kernels; pairs
+    # with cudnn.benchmark above so the autotuner measures the NHWC set.
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.vae.to(memory_format=torch.channels_last)
+    # Route attention through PyTorch SDPA so the FlashAttention backend
+    # handles the big 1024x1024 latents instead of materializing QK^T.
+    torch.backends.cuda.enable_flash_sdp(True)
+    try:
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        pipe.unet.set_attn_processor(AttnProcessor2_0())
+    except (ImportError, AttributeError) as err:
+        print(f"SDPA attention processor unavailable, keeping default: {err}")
+    # Decode latents per-image and in spatial tiles so the final VAE pass no
+    # longer sets the VRAM peak — that headroom goes to bigger UNet batches.
+    try:
+        pipe.vae.enable_slicing()
+        pipe.vae.enable_tiling()
+    except AttributeError as err:
+        print(f"VAE slicing/tiling unavailable: {err}")
+    if compile_models:
+        # Inductor fuses the elementwise epilogues into the matmuls/convs
+        # and cuts launch count; the compile cost is paid once per shape
+        # during warmup.
+        try:
+            pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=False)
+            pipe.vae.decode = torch.compile(pipe.vae.decode, mode="reduce-overhead")
+        except Exception as err:
+            print(f"torch.compile unavailable, running eager: {err}")
+    return pipe
+
+
+def warmup_pipeline(pipe, sizes):
+    """One tiny throwaway generation per distinct (width, height) so cudnn
+    autotuning and torch.compile pay their per-shape cost up front, before
+    the real batches are timed against them."""
+    with torch.inference_mode():
+        for width, height in sorted(sizes):
+            pipe(prompt="warmup", width=width, height=height,
+                 num_inference_steps=1, guidance_scale=0.0)
+
+
+class GraphedUNet:
+    """Replay the UNet forward as a captured CUDA graph per input shape.
+
+    The denoising loop calls the UNet `steps` times with identical tensor
+    shapes; dispatching each call through Python re-launches hundreds of
+    kernels. After a few eager warmup calls per shape we capture one forward
+    into a torch.cuda.CUDAGraph with static in/out tensors, then later calls
+    just copy inputs in and replay. Shapes that fail capture, or calls
+    carrying extra kwargs, fall back to the eager UNet.
+    """
+
+    WARMUP_CALLS = 3
+
+    def __init__(self, unet):
+        self._unet = unet
+        self._graphs = {}
+        self._eager_calls = {}
+        self._fallback_warned = False
+
+    def __getattr__(self, name):
+        return getattr(self._unet, name)
+
+    def __call__(self, sample, timestep, encoder_hidden_states, return_dict=True, **kwargs):
+        # Stock pipelines pass timestep_cond=None, cross_attention_kwargs=None
+        # and friends on every call; None kwargs carry no tensors and are
+        # capture-compatible, so only kwargs with real values force eager.
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        if kwargs:
+            if not self._fallback_warned:
+                self._fallback_warned = True
+                print("CUDA graphs not engaged: UNet called with "
+                      f"{sorted(kwargs)}; running eager (--CudaGraphs has no effect).")
+            return self._unet(sample, timestep, encoder_hidden_states,
+                              return_dict=return_dict, **kwargs)
+        if not torch.is_tensor(timestep):
+            timestep = torch.tensor(timestep, device=sample.device)
+        key = (tuple(sample.shape), tuple(encoder_hidden_states.shape))
+        entry = self._graphs.get(key)
+        if entry is None:
+            calls = self._eager_calls.get(key, 0) + 1
+            self._eager_calls[key] = calls
+            if calls <= self.WARMUP_CALLS:
+                return self._unet(sample, timestep, encoder_hidden_states,
+                                  return_dict=return_dict)
+            static_sample = sample.clone()
+            static_t = timestep.clone()
+            static_ehs = encoder_hidden_states.clone()
+            torch.cuda.synchronize()
+            graph = torch.cuda.CUDAGraph()
+            try:
+                with torch.cuda.graph(graph):
+                    static_out = self._unet(static_sample, static_t, static_ehs,
+                                            return_dict=False)[0]
+            except RuntimeError as err:
+                print(f"CUDA graph capture failed for {key}, staying eager: {err}")
+                self._eager_calls[key] = -(2 ** 30)
+                return self._unet(sample, timestep, encoder_hidden_states,
+                                  return_dict=return_dict)
+            entry = (graph, static_sample, static_t, static_ehs, static_out)
+            self._graphs[key] = entry
+        graph, static_sample, static_t, static_ehs, static_out = entry
+        static_sample.copy_(sample)
+        static_t.copy_(timestep)
+        static_ehs.copy_(encoder_hidden_states)
+        graph.replay()
+        if return_dict:
+            return types.SimpleNamespace(sample=static_out)
+        return (static_out,)
+
+
+# LRU of text-encoder outputs. Re-rolling seeds for the same prompt (and a
+# constant negative prompt across the whole manifest) would otherwise run
+# the text encoder redundantly — a real fraction of a 9-step Turbo render.
+_EMBED_CACHE = OrderedDict()
+_EMBED_CACHE_MAX = 256
+
+
+def _encode_cached(pipe, prompt, negative, do_cfg):
+    """Return (prompt_embeds, negative_prompt_embeds), encoding at most once
+    per (prompt, negative, cfg-enabled) combination."""
+    key = (prompt, negative, do_cfg)
+    if key in _EMBED_CACHE:
+        _EMBED_CACHE.move_to_end(key)
+        return _EMBED_CACHE[key]
+    embeds = pipe.encode_prompt(
+        prompt, device="cuda", num_images_per_prompt=1,
+        do_classifier_free_guidance=do_cfg, negative_prompt=negative)
+    entry = (embeds[0], embeds[1] if do_cfg else None)
+    _EMBED_CACHE[key] = entry
+    if len(_EMBED_CACHE) > _EMBED_CACHE_MAX:
+        _EMBED_CACHE.popitem(last=False)
+    return entry
+
+
+# Reused across calls: allocating a torch.Generator("cuda") per prompt adds
+# a device allocation (and potential sync) to every batch; reseeding a
+# persistent pool does not.
+_GEN_POOL = []
+
+
+def _generators(seeds):
+    """Return one pool generator per seed, reseeded in place."""
+    while len(_GEN_POOL) < len(seeds):
+        _GEN_POOL.append(torch.Generator("cuda"))
+    generators = _GEN_POOL[:len(seeds)]
+    for generator, seed in zip(generators, seeds):
+        generator.manual_seed(seed)
+    return generators
+
+
+def _batch_call_kwargs(pipe, batch):
+    """Build the pipeline kwargs for a list of prompts sharing identical
+    settings.
+
+    Every entry in `batch` must agree on width/height/steps/cfg/negative
+    prompt (the caller buckets by exactly that key); seeds may differ, so
+    each prompt gets its own generator.
+    """
+    random_seeds = torch.randint(0, 2 ** 32 - 1, (len(batch),), device="cpu").tolist()
+    seeds = [p["seed"] if p["seed"] is not None else random_seeds[i]
+             for i, p in enumerate(batch)]
+    generators = _generators(seeds)
+    first = batch[0]
+    negative = first["negative_prompt"]
+    # guidance_scale <= 1 means classifier-free guidance is off (the Turbo
+    # default); make sure the unconditional branch really is skipped — a
+    # lingering negative prompt would push the pipeline into the two-pass
+    # path, doubling UNet FLOPs per step for no visual effect.
+    do_cfg = first["cfg"] > 1.0
+    if not do_cfg:
+        negative = None
+    call_kwargs = {
+        "width": first["width"],
+        "height": first["height"],
+        "num_inference_steps": first["steps"],
+        "guidance_scale": first["cfg"],
+        "generator": generators,
+    }
+    if hasattr(pipe, "encode_prompt"):
+        encoded = [_encode_cached(pipe, p["prompt"], negative, do_cfg) for p in batch]
+        call_kwargs["prompt_embeds"] = torch.cat([e[0] for e in encoded])
+        call_kwargs["negative_prompt_embeds"] = (
+            torch.cat([e[1] for e in encoded]) if do_cfg else None)
+    else:
+        call_kwargs["prompt"] = [p["prompt"] for p in batch]
+        call_kwargs["negative_prompt"] = [negative] * len(batch) if negative else None
+    return call_kwargs
+
+
+def generate_batch(pipe, batch):
+    """Run one full pipeline call (denoise + decode) and return PIL images."""
+    with torch.inference_mode():
+        return pipe(**_batch_call_kwargs(pipe, batch)).images
+
+
+def generate_latents(pipe, batch):
+    """Run the denoising loop only, leaving the VAE decode to the caller."""
+    call_kwargs = _batch_call_kwargs(pipe, batch)
+    call_kwargs["output_type"] = "latent"
+    with torch.inference_mode():
+        return pipe(**call_kwargs).images
+
+
+def decode_latents(pipe, latents):
+    """Queue the VAE decode on the caller's current stream.
+
+    Returns the decoded image tensor; postprocessing to PIL (which syncs to
+    the CPU) is deliberately left to the caller, after the stream finishes.
+    """
+    with torch.inference_mode():
+        scaling = getattr(pipe.vae.config, "scaling_factor", 1.0)
+        return pipe.vae.decode(latents / scaling, return_dict=False)[0]
+
+
+def _serve_request(pipe, args, line):
+    """Render one daemon request (a JSON object on a single line)."""
+    line = line.strip()
+    if not line:
+        return {"ok": False, "error": "empty request"}
+    try:
+        req = json.loads(line)
+        p = {
+            "id": req.get("id", "prompt"),
+            "prompt": req["prompt"],
+            "negative_prompt": req.get("negative_prompt", args.Negative),
+            "width": (int(req.get("width", args.Width)) // 16) * 16,
+            "height": (int(req.get("height", args.Height)) // 16) * 16,
+            "steps": int(req.get("steps", args.Steps)),
+            "cfg": float(req.get("cfg", args.CFG)),
+            "seed": req.get("seed", args.Seed),
+        }
+        img = generate_batch(pipe, [p])[0]
+        out_path = req.get("output_path") or os.path.join(
+            args.OutputDir, f"{p['id']}_{datetime.now():%Y%m%d-%H%M%S}.png")
+        img.save(out_path)
+        return {"ok": True, "path": out_path}
+    except Exception as err:
+        return {"ok": False, "error": str(err)}
+
+
+def run_daemon(pipe, args):
+    """Keep the loaded pipeline resident and serve prompts as JSON lines.
+
+    Re-loading and re-staging the weights dominates cold-start for short
+    batches, so this mode pays that cost once and then answers requests
+    until interrupted. Each connection sends one JSON object per line
+    ({"prompt": ..., "output_path": ..., optional width/height/steps/cfg/
+    seed}) and receives a JSON reply with the written path. Platforms
+    without AF_UNIX fall back to a stdin/stdout loop.
+    """
+    if hasattr(socket, "AF_UNIX"):
+        if os.path.exists(args.DaemonSocket):
+            os.unlink(args.DaemonSocket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(args.DaemonSocket)
+        server.listen(1)
+        print(f"Pipeline resident; listening on {args.DaemonSocket} (Ctrl+C to stop).")
+        try:
+            while True:
+                conn, _addr = server.accept()
+                with conn, conn.makefile("rw", encoding="utf-8") as stream:
+                    for line in stream:
+                        stream.write(json.dumps(_serve_request(pipe, args, line)) + "\n")
+                        stream.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if os.path.exists(args.DaemonSocket):
+                os.unlink(args.DaemonSocket)
+    else:
+        print("AF_UNIX unavailable; pipeline resident, reading JSON lines from stdin.")
+        for line in sys.stdin:
+            print(json.dumps(_serve_request(pipe, args, line)), flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate Second Story art assets in batches.")
+    parser.add_argument("--Json", default=os.path.join("assets", "graphics_batch.json"),
+                        help="prompt manifest to render (default: assets/graphics_batch.json)")
+    parser.add_argument("--Prompt", default=None,
+                        help="render a single ad-hoc prompt instead of the manifest")
+    parser.add_argument("--OutputDir", default="output",
+                        help="directory for generated PNGs (default: output)")
+    parser.add_argument("--Steps", type=int, default=9, help="denoising steps (default: 9)")
+    parser.add_argument("--CFG", type=float, default=0.0, help="guidance scale (default: 0.0)")
+    parser.add_argument("--Width", type=int, default=1024, help="fallback width (default: 1024)")
+    parser.add_argument("--Height", type=int, default=1024, help="fallback height (default: 1024)")
+    parser.add_argument("--Negative", default=None, help="negative prompt applied to every image")
+    parser.add_argument("--Seed", type=int, default=None, help="fixed seed (default: random per image)")
+    parser.add_argument("--BatchSize", type=int, default=4,
+                        help="max prompts per pipeline call; lower if VRAM-bound (default: 4)")
+    parser.add_argument("--CudaGraphs", action="store_true",
+                        help="capture the UNet forward as a CUDA graph per shape and replay it")
+    parser.add_argument("--Quant", choices=["none", "int8", "fp8"], default="none",
+                        help="weight-only quantization for the UNet via torchao "
+                             "(fp8 needs Ada/Hopper; default: none, bf16)")
+    parser.add_argument("--DaemonSocket", default=None,
+                        help="keep the pipeline loaded and serve JSON-line prompts "
+                             "on this unix socket (stdin loop where AF_UNIX is missing)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.Negative and args.CFG <= 1.0:
+        print("--Negative is ignored at --CFG <= 1.0 (guidance is off); "
+              "raise --CFG for it to take effect.")
+    os.makedirs(args.OutputDir, exist_ok=True)
+
+    if args.DaemonSocket:
+        pipe = setup_pipeline(compile_models=not args.CudaGraphs, quant=args.Quant)
+        if args.CudaGraphs:
+            pipe.unet = GraphedUNet(pipe.unet)
+        warmup_pipeline(pipe, {((args.Width // 16) * 16, (args.Height // 16) * 16)})
+        run_daemon(pipe, args)
+        return
+
+    prompts_to_process = []
+    if args.Prompt:
+        prompts_to_process.append({
+            "id": "prompt",
+            "prompt": args.Prompt,
+            "negative_prompt": args.Negative,
+            "width": (args.Width // 16) * 16,
+            "height": (args.Height // 16) * 16,
+            "steps": args.Steps,
+            "cfg": args.CFG,
+            "seed": args.Seed,
+        })
+    else:
+        for entry in load_manifest(args.Json):
+            prompts_to_process.append({
+                "id": entry["id"],
+                "prompt": entry["description"],
+                "negative_prompt": args.Negative,
+                "width": (entry.get("Width", args.Width) // 16) * 16,
+                "height": (entry.get("Height", args.Height) // 16) * 16,
+                "steps": args.Steps,
+                "cfg": args.CFG,
+                "seed": args.Seed,
+            })
+
+    if not prompts_to_process:
+        print("Nothing to generate.")
+        return
+
+    # reduce-overhead compilation already records CUDA graphs internally, so
+    # the manual GraphedUNet wrapper and torch.compile are mutually exclusive.
+    pipe = setup_pipeline(compile_models=not args.CudaGraphs, quant=args.Quant)
+    if args.CudaGraphs:
+        pipe.unet = GraphedUNet(pipe.unet)
+
+    # cudnn.benchmark and torch.compile both cache kernels per input shape;
+    # running the manifest in JSON order would thrash those caches whenever
+    # consecutive entries differ in size. Sorting is stable, so entries keep
+    # their manifest order within a shape, and the insertion-ordered bucket
+    # dict below then visits each shape exactly once.
+    prompts_to_process.sort(key=lambda p: (p["width"], p["height"], p["steps"], p["cfg"]))
+
+    # Bucket prompts whose pipeline settings match so each pipe() call runs a
+    # full batch instead of a single image; throughput scales with batch size
+    # until VRAM runs out. Dimensions were already snapped to multiples of 16
+    # when the list was built.
+    buckets = {}
+    for p in prompts_to_process:
+        key = (p["width"], p["height"], p["steps"], p["cfg"], p["negative_prompt"])
+        buckets.setdefault(key, []).append(p)
+
+    warmup_pipeline(pipe, {(w, h) for (w, h, _s, _c, _n) in buckets})
+
+    total = len(prompts_to_process)
+    done = 0
+    # Per-prompt prints are real overhead on short Turbo runs; prefer one
+    # tqdm bar, falling back to prints when tqdm is not installed.
+    progress = tqdm(total=total, unit="img") if tqdm else None
+    # PNG deflate runs on the CPU while the GPU would otherwise sit idle;
+    # zlib releases the GIL, so saving on worker threads lets the next
+    # pipe() call start immediately. compress_level=1 — these are working
+    # files, encode speed beats a few percent of disk.
+    saver = ThreadPoolExecutor(max_workers=2)
+    save_futures = []
+    # One timestamp for the whole run; the old per-prompt strftime also used
+    # %m (month) where it meant %M, so files within a run could collide.
+    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    def save_batch(batch, images):
+        nonlocal done
+        for p, img in zip(batch, images):
+            keyword = _sanitize("", p["id"])
+            out_path = os.path.join(args.OutputDir, f"{keyword}_{ts}.png")
+            save_futures.append(
+                saver.submit(img.save, out_path, optimize=False, compress_level=1))
+            done += 1
+            if progress:
+                progress.update(1)
+            else:
+                print(f"  [{done}/{total}] {out_path}")
+
+    # Decode on a side stream so one batch's VAE pass overlaps the next
+    # batch's UNet steps on the default stream; `pending` holds the batch
+    # whose decode is still in flight.
+    overlap = hasattr(pipe, "vae") and hasattr(pipe, "image_processor")
+    decode_stream = torch.cuda.Stream() if overlap else None
+    pending = None
+
+    def flush_pending():
+        nonlocal pending
+        if pending is None:
+            return
+        decoded, pending_batch = pending
+        pending = None
+        decode_stream.synchronize()
+        save_batch(pending_batch, pipe.image_processor.postprocess(decoded, output_type="pil"))
+
+    first_bucket = True
+    for (width, height, _steps, _cfg, _neg), bucket in buckets.items():
+        # Only release pool blocks on a shape switch — the previous bucket's
+        # block sizes no longer fit. Calling empty_cache per batch would
+        # defeat the allocator pool and reintroduce cudaMalloc latency.
+        if not first_bucket:
+            flush_pending()
+            torch.cuda.empty_cache()
+        first_bucket = False
+        for start in range(0, len(bucket), args.BatchSize):
+            batch = bucket[start:start + args.BatchSize]
+            if progress:
+                progress.set_description(f"{width}x{height}")
+            else:
+                print(f"Generating {len(batch)} image(s) at {width}x{height}...")
+            if overlap:
+                latents = generate_latents(pipe, batch)
+                flush_pending()
+                decode_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(decode_stream):
+                    # Keep the allocator from handing the latents' memory
+                    # back to the default stream mid-decode.
+                    latents.record_stream(decode_stream)
+                    pending = (decode_latents(pipe, latents), batch)
+            else:
+                save_batch(batch, generate_batch(pipe, batch))
+    flush_pending()
+    saver.shutdown(wait=True)
+    if progress:
+        progress.close()
+    # The whole point of the run is the files on disk: surface any save that
+    # failed in the background (bad path, full disk, encode error) instead
+    # of exiting 0 with PNGs missing.
+    failed = 0
+    for future in save_futures:
+        try:
+            future.result()
+        except Exception as err:
+            failed += 1
+            print(f"save failed: {err}")
+    if failed:
+        sys.exit(f"{failed} of {total} image save(s) failed.")
+
+
+if __name__ == "__main__":
+    main()